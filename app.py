@@ -1,27 +1,58 @@
-﻿import json
+﻿import copy
+import functools
+import hashlib
+import json
+import os
+import re
+import struct
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional, Literal, Tuple
 
-from fastapi import FastAPI, HTTPException
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from PIL import Image
+
+try:
+    import orjson
+except ImportError:  # stdlib json fallback
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:  # scalar fallback
+    np = None
 
 BASE_DIR = Path(__file__).resolve().parent
 ROOT_DIR = BASE_DIR.parent
 DATASET_ROOT = ROOT_DIR / "dataset"
 METADATA_FILENAME = "metadata.json"
+JOURNAL_FILENAME = "metadata.jsonl"
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
 
 GRID_SIZE = 64
+_GRID_MASK = GRID_SIZE - 1
+assert GRID_SIZE & _GRID_MASK == 0, "GRID_SIZE must be a power of two"
 
-try:
-    RESAMPLE_MODE = Image.Resampling.LANCZOS
-except AttributeError:  # Pillow<9.1 fallback
-    RESAMPLE_MODE = Image.LANCZOS
+_PIL_IMAGE = None
+RESAMPLE_MODE = None
+
+
+def _pil_image():
+    """Import PIL on first use so read-only endpoints skip its startup cost."""
+    global _PIL_IMAGE, RESAMPLE_MODE
+    if _PIL_IMAGE is None:
+        from PIL import Image
+        try:
+            RESAMPLE_MODE = Image.Resampling.LANCZOS
+        except AttributeError:  # Pillow<9.1 fallback
+            RESAMPLE_MODE = Image.LANCZOS
+        _PIL_IMAGE = Image
+    return _PIL_IMAGE
 
 app = FastAPI(title="Dataset Captioning UI")
 app.add_middleware(
@@ -34,7 +65,52 @@ app.add_middleware(
 
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 
-_store_lock = threading.Lock()
+_store_lock = threading.RLock()
+
+# One lock per dataset so writes to distinct datasets don't serialize;
+# _store_lock keeps guarding the module-level caches.
+_dataset_locks: Dict[str, threading.RLock] = {}
+
+
+def _dataset_lock(dataset: str) -> threading.RLock:
+    with _store_lock:
+        lock = _dataset_locks.get(dataset)
+        if lock is None:
+            lock = threading.RLock()
+            _dataset_locks[dataset] = lock
+        return lock
+
+# Parsed-and-normalized metadata per dataset, keyed by the (mtime_ns, size)
+# of both the base file and the journal so external edits are picked up.
+_METADATA_CACHE: Dict[str, Tuple[Tuple[int, int, int, int], Dict[str, object]]] = {}
+
+_IMAGE_SUFFIXES = {ext.lstrip(".") for ext in IMAGE_EXTENSIONS}
+
+# Sorted image listings per train dir, keyed by (generation, dir mtime).
+# The generation counter is bumped by write endpoints to force a rescan.
+_LISTING_CACHE: Dict[Path, Tuple[int, int, List[Path]]] = {}
+_LISTING_GENERATION = 0
+
+
+def _invalidate_listing_cache() -> None:
+    global _LISTING_GENERATION
+    with _store_lock:
+        _LISTING_GENERATION += 1
+
+
+# Journal compactions scheduled but not yet flushed, per dataset.
+_PENDING_COMPACTIONS: Dict[str, threading.Timer] = {}
+_COMPACT_DELAY_SECONDS = 0.2
+
+# Shared pool for per-image header probes; each probe releases the GIL
+# while reading, so the listing build overlaps file I/O across images.
+_PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="dim-probe")
+
+# Caption token sets per dataset, populated lazily on the first vocabulary
+# request and patched by _save_metadata so GET stays O(1) steady-state.
+_DATASET_VOCAB: Dict[str, set] = {}
+_GLOBAL_VOCAB_SORTED: Optional[List[str]] = None
+_VOCAB_INITIALIZED = False
 
 
 def _ensure_dataset(dataset: str) -> Path:
@@ -44,16 +120,67 @@ def _ensure_dataset(dataset: str) -> Path:
     return train_dir
 
 
+def _file_state(path: Path) -> Tuple[int, int]:
+    try:
+        stat = path.stat()
+    except OSError:
+        return (0, 0)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _metadata_state(train_dir: Path) -> Tuple[int, int, int, int]:
+    return _file_state(train_dir / METADATA_FILENAME) + _file_state(train_dir / JOURNAL_FILENAME)
+
+
+def _replay_journal(dataset: str, journal_path: Path, items: Dict[str, object]) -> None:
+    try:
+        raw = journal_path.read_bytes()
+    except OSError:
+        return
+    loads = orjson.loads if orjson is not None else json.loads
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        try:
+            record = loads(line)
+        except ValueError:
+            continue
+        if not isinstance(record, dict):
+            continue
+        raw_key = record.get("k")
+        if not isinstance(raw_key, str):
+            continue
+        key = _normalize_key(dataset, raw_key)
+        if key is not None:
+            items[key] = record.get("v")
+
+
 def _load_metadata(dataset: str) -> Dict[str, object]:
     train_dir = _ensure_dataset(dataset)
     metadata_path = train_dir / METADATA_FILENAME
+    journal_path = train_dir / JOURNAL_FILENAME
+    state = _metadata_state(train_dir)
+    if state == (0, 0, 0, 0):
+        with _store_lock:
+            _METADATA_CACHE.pop(dataset, None)
+        return {}
+    with _store_lock:
+        cached = _METADATA_CACHE.get(dataset)
+        if cached is not None and cached[0] == state:
+            return copy.deepcopy(cached[1])
+    normalized: Dict[str, object] = {}
     if metadata_path.exists():
-        with metadata_path.open("r", encoding="utf-8") as fh:
-            payload = json.load(fh)
+        if orjson is not None:
+            payload = orjson.loads(metadata_path.read_bytes())
+        else:
+            with metadata_path.open("r", encoding="utf-8") as fh:
+                payload = json.load(fh)
         if isinstance(payload, dict):
-            return _normalize_metadata_keys(dataset, payload)
-        return {}
-    return {}
+            normalized = _normalize_metadata_keys(dataset, payload)
+    _replay_journal(dataset, journal_path, normalized)
+    with _store_lock:
+        _METADATA_CACHE[dataset] = (state, copy.deepcopy(normalized))
+    return normalized
 
 
 def _save_metadata(dataset: str, data: Dict[str, object]) -> None:
@@ -61,96 +188,221 @@ def _save_metadata(dataset: str, data: Dict[str, object]) -> None:
     metadata_path = train_dir / METADATA_FILENAME
     metadata_path.parent.mkdir(parents=True, exist_ok=True)
     normalized = _normalize_metadata_keys(dataset, data)
-    with metadata_path.open("w", encoding="utf-8") as fh:
-        json.dump(normalized, fh, ensure_ascii=False, indent=4, sort_keys=True)
+    if orjson is not None:
+        payload = orjson.dumps(normalized, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(normalized, ensure_ascii=False, indent=4, sort_keys=True).encode("utf-8")
+    # Write to a sibling temp file and swap it in so a crash mid-write
+    # can never leave a truncated metadata.json behind.
+    tmp_path = metadata_path.with_suffix(".json.tmp")
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, metadata_path)
+    try:
+        (train_dir / JOURNAL_FILENAME).unlink()
+    except OSError:
+        pass
+    state = _metadata_state(train_dir)
+    with _store_lock:
+        _METADATA_CACHE[dataset] = (state, copy.deepcopy(normalized))
+        timer = _PENDING_COMPACTIONS.pop(dataset, None)
+    if timer is not None:
+        timer.cancel()
+    _update_dataset_vocab(dataset, normalized)
+
+
+def _compact_now(dataset: str) -> None:
+    with _store_lock:
+        _PENDING_COMPACTIONS.pop(dataset, None)
+    try:
+        with _dataset_lock(dataset):
+            _save_metadata(dataset, _load_metadata(dataset))
+    except HTTPException:
+        pass
+
+
+def _maybe_compact(dataset: str, train_dir: Path) -> None:
+    journal_size = _file_state(train_dir / JOURNAL_FILENAME)[1]
+    base_size = _file_state(train_dir / METADATA_FILENAME)[1]
+    if journal_size <= max(base_size // 2, 4096):
+        return
+    # Debounce so a burst of rapid edits triggers one rewrite, not one per save.
+    with _store_lock:
+        timer = _PENDING_COMPACTIONS.get(dataset)
+        if timer is not None:
+            timer.cancel()
+        timer = threading.Timer(_COMPACT_DELAY_SECONDS, _compact_now, args=(dataset,))
+        timer.daemon = True
+        _PENDING_COMPACTIONS[dataset] = timer
+        timer.start()
+
+
+def _save_metadata_delta(dataset: str, metadata_key: str, value: object, items: Dict[str, object]) -> None:
+    """Append a single-entry delta to the journal instead of rewriting the base file.
+
+    `items` is the caller's full, already-updated dict; it refreshes the
+    caches and feeds compaction once the journal outgrows the base file.
+    """
+    train_dir = _ensure_dataset(dataset)
+    journal_path = train_dir / JOURNAL_FILENAME
+    record = {"k": metadata_key, "v": value}
+    if orjson is not None:
+        line = orjson.dumps(record) + b"\n"
+    else:
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+    with journal_path.open("ab") as fh:
+        fh.write(line)
+    state = _metadata_state(train_dir)
+    with _store_lock:
+        _METADATA_CACHE[dataset] = (state, copy.deepcopy(items))
+    _update_dataset_vocab(dataset, items)
+    _maybe_compact(dataset, train_dir)
+
+
+# One comma-separated token: first and last char non-space, commas excluded.
+_TOKEN_RE = re.compile(r"[^,\s](?:[^,]*[^,\s])?")
 
 
 def _split_caption(caption: str) -> List[str]:
-    return [chunk.strip() for chunk in caption.split(",") if chunk.strip()]
+    return _TOKEN_RE.findall(caption)
 
 
-def _collect_global_vocabulary() -> List[str]:
+def _caption_tokens(items: Dict[str, object]) -> set:
     words = set()
+    for entry in items.values():
+        caption = entry.get("caption") if isinstance(entry, dict) else None
+        if isinstance(caption, str):
+            words.update(_TOKEN_RE.findall(caption))
+    return words
+
+
+def _update_dataset_vocab(dataset: str, items: Dict[str, object]) -> None:
+    global _GLOBAL_VOCAB_SORTED
+    with _store_lock:
+        _DATASET_VOCAB[dataset] = _caption_tokens(items)
+        _GLOBAL_VOCAB_SORTED = None
+
+
+def _ensure_vocab_index() -> None:
+    global _VOCAB_INITIALIZED
+    with _store_lock:
+        if _VOCAB_INITIALIZED:
+            return
+        _VOCAB_INITIALIZED = True
     if not DATASET_ROOT.exists():
-        return []
-    for metadata_path in DATASET_ROOT.rglob(METADATA_FILENAME):
+        return
+    # Dataset dirs are direct children of DATASET_ROOT, each with one
+    # metadata.json at its top level, so a shallow scan is enough.
+    for child in DATASET_ROOT.iterdir():
+        if not child.is_dir():
+            continue
+        dataset = child.name
         try:
-            with metadata_path.open("r", encoding="utf-8") as fh:
-                payload = json.load(fh)
-        except (OSError, json.JSONDecodeError):
+            items = _load_metadata(dataset)
+        except (OSError, json.JSONDecodeError, ValueError, HTTPException):
             continue
-        for entry in payload.values():
-            caption = entry.get("caption") if isinstance(entry, dict) else None
-            if isinstance(caption, str):
-                words.update(_split_caption(caption))
-    return sorted(words)
+        with _store_lock:
+            if dataset not in _DATASET_VOCAB:
+                _update_dataset_vocab(dataset, items)
+
+
+def _collect_global_vocabulary() -> List[str]:
+    global _GLOBAL_VOCAB_SORTED
+    _ensure_vocab_index()
+    with _store_lock:
+        if _GLOBAL_VOCAB_SORTED is None:
+            merged = set()
+            for words in _DATASET_VOCAB.values():
+                merged.update(words)
+            _GLOBAL_VOCAB_SORTED = sorted(merged)
+        return _GLOBAL_VOCAB_SORTED
 
 
 def _collect_dataset_vocabulary(dataset: str) -> List[str]:
-    items = _load_metadata(dataset)
-    words = set()
-    for entry in items.values():
-        caption = entry.get("caption") if isinstance(entry, dict) else None
-        if isinstance(caption, str):
-            words.update(_split_caption(caption))
+    with _store_lock:
+        words = _DATASET_VOCAB.get(dataset)
+    if words is None:
+        _update_dataset_vocab(dataset, _load_metadata(dataset))
+        with _store_lock:
+            words = _DATASET_VOCAB[dataset]
     return sorted(words)
 
 
-def _list_image_files(train_dir: Path) -> List[Path]:
+def _scan_image_files(train_dir: Path) -> List[Path]:
     files: List[Path] = []
-    for path in train_dir.rglob("*"):
-        if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS:
-            files.append(path)
-    return sorted(files, key=lambda p: p.relative_to(train_dir).as_posix().lower())
+    stack = [str(train_dir)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif "." in entry.name and entry.name.rpartition(".")[2].lower() in _IMAGE_SUFFIXES:
+                        if entry.is_file():
+                            files.append(Path(entry.path))
+        except OSError:
+            continue
+    files.sort(key=lambda p: p.relative_to(train_dir).as_posix().lower())
+    return files
+
+
+def _list_image_files(train_dir: Path) -> List[Path]:
+    try:
+        dir_mtime = train_dir.stat().st_mtime_ns
+    except OSError:
+        return []
+    with _store_lock:
+        cached = _LISTING_CACHE.get(train_dir)
+        if cached is not None and cached[0] == _LISTING_GENERATION and cached[1] == dir_mtime:
+            return cached[2]
+    files = _scan_image_files(train_dir)
+    with _store_lock:
+        _LISTING_CACHE[train_dir] = (_LISTING_GENERATION, dir_mtime, files)
+    return files
 
 
 def _make_metadata_key(dataset: str, relative_path: str) -> str:
     rel = Path(relative_path.replace("\\", "/"))
     return (Path("dataset") / dataset / rel).as_posix()
 
+@functools.lru_cache(maxsize=65536)
+def _normalize_key(dataset: str, raw_key: str) -> Optional[str]:
+    """Normalize a single metadata key, or None if it should be dropped."""
+    sanitized = raw_key.replace("\\", "/").strip()
+    if not sanitized:
+        return None
+    if sanitized.startswith("./"):
+        sanitized = sanitized[2:]
+    sanitized = sanitized.lstrip("/")
+    original_parts = [part for part in sanitized.split("/") if part]
+    if not original_parts:
+        return None
+    fallback_key = "/".join(original_parts)
+    had_dataset_prefix = original_parts[0].lower() == "dataset"
+    parts = original_parts[1:] if had_dataset_prefix else original_parts
+    if not parts:
+        return fallback_key
+    if parts[0].lower() == dataset.lower():
+        rel_parts = parts[1:]
+    elif not had_dataset_prefix:
+        rel_parts = parts
+    else:
+        rel_parts = []
+    rel_parts = [part for part in rel_parts if part]
+    if rel_parts:
+        return _make_metadata_key(dataset, "/".join(rel_parts))
+    return fallback_key
+
+
 def _normalize_metadata_keys(dataset: str, payload: Dict[str, object]) -> Dict[str, object]:
     normalized: Dict[str, object] = {}
     if not isinstance(payload, dict):
         return normalized
-    dataset_lower = dataset.lower()
     for raw_key, value in payload.items():
         if not isinstance(raw_key, str):
             continue
-        sanitized = raw_key.replace("\\", "/").strip()
-        if not sanitized:
-            continue
-        if sanitized.startswith("./"):
-            sanitized = sanitized[2:]
-        sanitized = sanitized.lstrip("/")
-        parts = [part for part in sanitized.split("/") if part]
-        if not parts:
-            continue
-        original_parts = parts[:]
-        fallback_key = "/".join(original_parts)
-        had_dataset_prefix = False
-        if original_parts and original_parts[0].lower() == "dataset":
-            had_dataset_prefix = True
-            parts = original_parts[1:]
-        else:
-            parts = original_parts
-        if not parts:
-            if fallback_key not in normalized:
-                normalized[fallback_key] = value
-            continue
-        if parts[0].lower() == dataset_lower:
-            rel_parts = parts[1:]
-        elif not had_dataset_prefix:
-            rel_parts = parts
-        else:
-            rel_parts = []
-        rel_parts = [part for part in rel_parts if part]
-        if rel_parts:
-            normalized_key = _make_metadata_key(dataset, "/".join(rel_parts))
-            if normalized_key not in normalized:
-                normalized[normalized_key] = value
-            continue
-        if fallback_key not in normalized:
-            normalized[fallback_key] = value
+        key = _normalize_key(dataset, raw_key)
+        if key is not None and key not in normalized:
+            normalized[key] = value
     return normalized
 
 
@@ -178,59 +430,45 @@ class DatasetListResponse(BaseModel):
     datasets: List[str]
 
 
-class ImageRecord(BaseModel):
-    name: str
-    path: str
-    caption: str
-    train_resolution: List[int]
-    image_resolution: List[int]
-    annotated: bool
-
-
-class DatasetImagesResponse(BaseModel):
-    dataset: str
-    images: List[ImageRecord]
-
-
 def _round_up_to_grid(value: int) -> int:
     """Return the smallest GRID_SIZE-multiple that fits `value`."""
-    if value <= 0:
-        return GRID_SIZE
-    if value % GRID_SIZE == 0:
-        return value
-    return ((value // GRID_SIZE) + 1) * GRID_SIZE
+    return max(GRID_SIZE, (value + _GRID_MASK) & ~_GRID_MASK)
 
 
 def _aligned_resolution(height: int, width: int) -> List[int]:
     """Compute training resolution aligned to GRID_SIZE for metadata storage."""
-    return [_round_up_to_grid(height), _round_up_to_grid(width)]
+    return [
+        max(GRID_SIZE, (height + _GRID_MASK) & ~_GRID_MASK),
+        max(GRID_SIZE, (width + _GRID_MASK) & ~_GRID_MASK),
+    ]
 
 
 def _apply_crop(image_path: Path, crop: CropData) -> List[int]:
+    Image = _pil_image()
     with Image.open(image_path) as img:
         width, height = img.size
-        crop_width = int(round(crop.width))
-        crop_height = int(round(crop.height))
+        crop_width = int(crop.width + 0.5)
+        crop_height = int(crop.height + 0.5)
         if crop_width <= 0 or crop_height <= 0:
             raise HTTPException(status_code=400, detail="Invalid crop dimensions")
         crop_width = min(crop_width, width)
         crop_height = min(crop_height, height)
-        left = int(round(crop.x))
-        top = int(round(crop.y))
-        max_left = max(0, width - crop_width)
-        max_top = max(0, height - crop_height)
-        if left < 0:
-            left = 0
-        if top < 0:
-            top = 0
-        if left > max_left:
-            left = max_left
-        if top > max_top:
-            top = max_top
-        right = left + crop_width
-        bottom = top + crop_height
-        cropped = img.crop((left, top, right, bottom))
-        cropped.save(image_path)
+        left = max(0, min(width - crop_width, int(crop.x + 0.5)))
+        top = max(0, min(height - crop_height, int(crop.y + 0.5)))
+        cropped = img.crop((left, top, left + crop_width, top + crop_height))
+        save_kwargs = {}
+        if img.format == "JPEG" and left % 8 == 0 and top % 8 == 0 and hasattr(img, "quantization"):
+            # MCU-aligned crop of a JPEG: carry the source quantization and
+            # subsampling over so libjpeg reuses them instead of re-deciding.
+            cropped.format = "JPEG"
+            cropped.quantization = img.quantization
+            if hasattr(img, "layer"):
+                cropped.layer = img.layer
+            save_kwargs = {"quality": "keep", "subsampling": "keep", "qtables": "keep"}
+        try:
+            cropped.save(image_path, **save_kwargs)
+        except ValueError:
+            cropped.save(image_path)
         return [cropped.height, cropped.width]
 
 def _extend_image(image_path: Path, anchor: str) -> Tuple[List[int], str]:
@@ -239,6 +477,12 @@ def _extend_image(image_path: Path, anchor: str) -> Tuple[List[int], str]:
         normalized = 'cm'
     horizontal = normalized[0]
     vertical = normalized[1]
+    probed = _fast_image_size(image_path)
+    if probed is not None:
+        height, width = probed
+        if width % GRID_SIZE == 0 and height % GRID_SIZE == 0:
+            return [height, width], 'unchanged'
+    Image = _pil_image()
     with Image.open(image_path) as img:
         width, height = img.size
         target_width = ((width + GRID_SIZE - 1) // GRID_SIZE) * GRID_SIZE
@@ -295,11 +539,28 @@ def _extend_image(image_path: Path, anchor: str) -> Tuple[List[int], str]:
 
 def _resize_image(image_path: Path, max_side: int) -> List[int]:
     max_side = max(1, int(max_side))
+    Image = _pil_image()
     with Image.open(image_path) as img:
         width, height = img.size
         longest_side = max(width, height)
         if longest_side <= max_side:
             return [height, width]
+        drafted = False
+        if img.format == "JPEG":
+            # libjpeg can IDCT-scale by 1/2, 1/4 or 1/8 during decode; pick the
+            # largest divisor that still leaves the longest side >= max_side.
+            divisor = 1
+            while divisor < 8 and longest_side // (divisor * 2) >= max_side:
+                divisor *= 2
+            if divisor > 1:
+                img.draft("RGB", (width // divisor, height // divisor))
+                drafted = True
+                width, height = img.size
+                longest_side = max(width, height)
+                if longest_side <= max_side:
+                    resized = img.copy()
+                    resized.save(image_path)
+                    return [resized.height, resized.width]
         scale = max_side / float(longest_side)
         new_width = max(1, int(round(width * scale)))
         new_height = max(1, int(round(height * scale)))
@@ -314,25 +575,112 @@ def _resize_image(image_path: Path, max_side: int) -> List[int]:
                 new_height = max_side
                 new_width = max(1, int(round(new_height * aspect_ratio)))
         if new_width == width and new_height == height:
+            if drafted:
+                resized = img.copy()
+                resized.save(image_path)
             return [height, width]
         resized = img.resize((new_width, new_height), RESAMPLE_MODE)
         resized.save(image_path)
         return [resized.height, resized.width]
 
 
+def _jpeg_size(fh) -> Optional[List[int]]:
+    fh.seek(2)
+    while True:
+        marker = fh.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        while code == 0xFF:
+            nxt = fh.read(1)
+            if not nxt:
+                return None
+            code = nxt[0]
+        if code in (0x01, 0xD8) or 0xD0 <= code <= 0xD7:
+            continue
+        length_bytes = fh.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length,) = struct.unpack(">H", length_bytes)
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            body = fh.read(5)
+            if len(body) < 5:
+                return None
+            height, width = struct.unpack(">HH", body[1:5])
+            return [height, width]
+        fh.seek(length - 2, 1)
+
+
+def _webp_size(head: bytes) -> Optional[List[int]]:
+    chunk = head[12:16]
+    if chunk == b"VP8 " and len(head) >= 30:
+        width = struct.unpack("<H", head[26:28])[0] & 0x3FFF
+        height = struct.unpack("<H", head[28:30])[0] & 0x3FFF
+        return [height, width]
+    if chunk == b"VP8L" and len(head) >= 25 and head[20] == 0x2F:
+        bits = struct.unpack("<I", head[21:25])[0]
+        width = (bits & 0x3FFF) + 1
+        height = ((bits >> 14) & 0x3FFF) + 1
+        return [height, width]
+    if chunk == b"VP8X" and len(head) >= 30:
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        return [height, width]
+    return None
+
+
+def _fast_image_size(path: Path) -> Optional[List[int]]:
+    """Read (height, width) from the file header without PIL decoder setup."""
+    try:
+        with path.open("rb") as fh:
+            head = fh.read(30)
+            if len(head) >= 24 and head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+                width, height = struct.unpack(">II", head[16:24])
+                return [height, width]
+            if len(head) >= 26 and head[:2] == b"BM":
+                width, height = struct.unpack("<ii", head[18:26])
+                return [abs(height), width]
+            if len(head) >= 16 and head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                return _webp_size(head)
+            if len(head) >= 2 and head[:2] == b"\xff\xd8":
+                return _jpeg_size(fh)
+    except (OSError, struct.error, IndexError):
+        return None
+    return None
+
+
 def _get_image_dimensions(path: Path) -> List[int]:
+    dimensions = _fast_image_size(path)
+    if dimensions is not None:
+        return dimensions
+    Image = _pil_image()
     with Image.open(path) as img:
         width, height = img.size
     return [height, width]
 
 
+@functools.lru_cache(maxsize=64)
+def _resolved_train_dir(dataset: str) -> Path:
+    return (DATASET_ROOT / dataset).resolve()
+
+
+def _record_image_state(entry: Dict[str, object], image_file: Path, image_resolution: List[int]) -> None:
+    entry["image_resolution"] = [int(image_resolution[0]), int(image_resolution[1])]
+    try:
+        entry["image_mtime_ns"] = image_file.stat().st_mtime_ns
+    except OSError:
+        entry.pop("image_mtime_ns", None)
+
+
 def _resolve_image_path(dataset: str, image_path: str) -> Path:
-    train_dir = _ensure_dataset(dataset)
-    candidate = (train_dir / image_path).resolve()
+    _ensure_dataset(dataset)
+    base = _resolved_train_dir(dataset)
+    candidate = (base / image_path).resolve()
     if not candidate.exists() or not candidate.is_file():
         raise HTTPException(status_code=404, detail="Image not found")
     try:
-        candidate.relative_to(train_dir.resolve())
+        if os.path.commonpath([str(candidate), str(base)]) != str(base):
+            raise ValueError(candidate)
     except ValueError as exc:
         raise HTTPException(status_code=400, detail="Invalid image path") from exc
     return candidate
@@ -353,36 +701,86 @@ async def list_datasets() -> DatasetListResponse:
     return DatasetListResponse(datasets=datasets)
 
 
-@app.get("/api/datasets/{dataset}/images", response_model=DatasetImagesResponse)
-async def dataset_images(dataset: str) -> DatasetImagesResponse:
+def _metadata_etag(train_dir: Path) -> str:
+    digest = hashlib.blake2b(repr(_metadata_state(train_dir)).encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
+
+
+def _dataset_images_etag(train_dir: Path) -> str:
+    files = _list_image_files(train_dir)
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(repr(_metadata_state(train_dir)).encode())
+    hasher.update(str(_LISTING_GENERATION).encode())
+    hasher.update("\0".join(path.as_posix() for path in files).encode())
+    return f'"{hasher.hexdigest()}"'
+
+
+def _build_dataset_images(dataset: str) -> Dict[str, object]:
     train_dir = _ensure_dataset(dataset)
     metadata = _load_metadata(dataset)
-    images: List[ImageRecord] = []
-    for image_path in _list_image_files(train_dir):
+    image_paths = _list_image_files(train_dir)
+    resolutions = list(_PROBE_EXECUTOR.map(_get_image_dimensions, image_paths))
+    relative_paths: List[str] = []
+    captions: List[str] = []
+    heights: List[int] = []
+    widths: List[int] = []
+    for image_path, actual_resolution in zip(image_paths, resolutions):
         relative_path = image_path.relative_to(train_dir).as_posix()
         key = _make_metadata_key(dataset, relative_path)
         entry = metadata.get(key, {})
         caption_value = entry.get("caption") if isinstance(entry, dict) else ""
-        caption_text = caption_value or ""
-        actual_resolution = _get_image_dimensions(image_path)
         raw_resolution = entry.get("train_resolution") if isinstance(entry, dict) else None
+        height_value = int(actual_resolution[0])
+        width_value = int(actual_resolution[1])
         if isinstance(raw_resolution, list) and len(raw_resolution) == 2:
-            height_value = max(int(raw_resolution[0]), int(actual_resolution[0]))
-            width_value = max(int(raw_resolution[1]), int(actual_resolution[1]))
-            train_resolution = _aligned_resolution(height_value, width_value)
-        else:
-            train_resolution = _aligned_resolution(actual_resolution[0], actual_resolution[1])
+            height_value = max(int(raw_resolution[0]), height_value)
+            width_value = max(int(raw_resolution[1]), width_value)
+        relative_paths.append(relative_path)
+        captions.append(caption_value or "")
+        heights.append(height_value)
+        widths.append(width_value)
+    if np is not None and image_paths:
+        aligned_h = np.maximum(
+            (np.asarray(heights, dtype=np.int64) + _GRID_MASK) & ~_GRID_MASK, GRID_SIZE
+        ).tolist()
+        aligned_w = np.maximum(
+            (np.asarray(widths, dtype=np.int64) + _GRID_MASK) & ~_GRID_MASK, GRID_SIZE
+        ).tolist()
+    else:
+        aligned_h = [max(GRID_SIZE, (value + _GRID_MASK) & ~_GRID_MASK) for value in heights]
+        aligned_w = [max(GRID_SIZE, (value + _GRID_MASK) & ~_GRID_MASK) for value in widths]
+    images: List[Dict[str, object]] = []
+    for relative_path, caption_text, actual_resolution, train_h, train_w in zip(
+        relative_paths, captions, resolutions, aligned_h, aligned_w
+    ):
         images.append(
-            ImageRecord(
-                name=relative_path,
-                path=relative_path,
-                caption=caption_text,
-                train_resolution=[int(train_resolution[0]), int(train_resolution[1])],
-                image_resolution=[int(actual_resolution[0]), int(actual_resolution[1])],
-                annotated=bool(caption_text.strip()),
-            )
+            {
+                "name": relative_path,
+                "path": relative_path,
+                "caption": caption_text,
+                "train_resolution": [int(train_h), int(train_w)],
+                "image_resolution": [int(actual_resolution[0]), int(actual_resolution[1])],
+                "annotated": bool(caption_text.strip()),
+            }
         )
-    return DatasetImagesResponse(dataset=dataset, images=images)
+    return {"dataset": dataset, "images": images}
+
+
+@app.get("/api/datasets/{dataset}/images")
+async def dataset_images(dataset: str, request: Request):
+    def build():
+        train_dir = _ensure_dataset(dataset)
+        etag = _dataset_images_etag(train_dir)
+        if request.headers.get("if-none-match") == etag:
+            return etag, None
+        return etag, _build_dataset_images(dataset)
+
+    etag, payload = await anyio.to_thread.run_sync(build)
+    if payload is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    if orjson is not None:
+        return ORJSONResponse(payload, headers={"ETag": etag})
+    return JSONResponse(payload, headers={"ETag": etag})
 
 
 @app.get("/api/datasets/{dataset}/images/{image_path:path}")
@@ -392,9 +790,15 @@ async def dataset_image_file(dataset: str, image_path: str) -> FileResponse:
 
 
 @app.get("/api/datasets/{dataset}/metadata")
-async def dataset_metadata(dataset: str) -> JSONResponse:
+async def dataset_metadata(dataset: str, request: Request) -> JSONResponse:
+    train_dir = _ensure_dataset(dataset)
+    etag = _metadata_etag(train_dir)
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
     metadata = _load_metadata(dataset)
-    return JSONResponse(metadata)
+    if orjson is not None:
+        return ORJSONResponse(metadata, headers={"ETag": etag})
+    return JSONResponse(metadata, headers={"ETag": etag})
 
 
 @app.get("/api/datasets/{dataset}/vocabulary")
@@ -408,11 +812,10 @@ async def vocabulary() -> Dict[str, List[str]]:
     return {"words": _collect_global_vocabulary()}
 
 
-@app.post("/api/datasets/{dataset}/images/{image_path:path}/resize")
-async def resize_image(dataset: str, image_path: str, payload: ResizeRequest) -> Dict[str, object]:
+def _do_resize_image(dataset: str, image_path: str, payload: ResizeRequest) -> Dict[str, object]:
     image_file = _resolve_image_path(dataset, image_path)
     metadata_key = _make_metadata_key(dataset, image_path)
-    with _store_lock:
+    with _dataset_lock(dataset):
         metadata = _load_metadata(dataset)
         entry = metadata.get(metadata_key)
         if not isinstance(entry, dict):
@@ -421,15 +824,22 @@ async def resize_image(dataset: str, image_path: str, payload: ResizeRequest) ->
         aligned_resolution = _aligned_resolution(image_resolution[0], image_resolution[1])
         entry["caption"] = entry.get("caption", "")
         entry["train_resolution"] = aligned_resolution
+        _record_image_state(entry, image_file, image_resolution)
         metadata[metadata_key] = entry
-        _save_metadata(dataset, metadata)
+        _save_metadata_delta(dataset, metadata_key, entry, metadata)
+        _invalidate_listing_cache()
     return {"status": "ok", "train_resolution": aligned_resolution, "image_resolution": image_resolution}
 
-@app.post("/api/datasets/{dataset}/images/{image_path:path}/extend")
-async def extend_image(dataset: str, image_path: str, payload: ExtendRequest) -> Dict[str, object]:
+
+@app.post("/api/datasets/{dataset}/images/{image_path:path}/resize")
+async def resize_image(dataset: str, image_path: str, payload: ResizeRequest) -> Dict[str, object]:
+    return await anyio.to_thread.run_sync(_do_resize_image, dataset, image_path, payload)
+
+
+def _do_extend_image(dataset: str, image_path: str, payload: ExtendRequest) -> Dict[str, object]:
     image_file = _resolve_image_path(dataset, image_path)
     metadata_key = _make_metadata_key(dataset, image_path)
-    with _store_lock:
+    with _dataset_lock(dataset):
         metadata = _load_metadata(dataset)
         entry = metadata.get(metadata_key)
         if not isinstance(entry, dict):
@@ -438,17 +848,22 @@ async def extend_image(dataset: str, image_path: str, payload: ExtendRequest) ->
         aligned_resolution = _aligned_resolution(image_resolution[0], image_resolution[1])
         entry["caption"] = entry.get("caption", "")
         entry["train_resolution"] = aligned_resolution
+        _record_image_state(entry, image_file, image_resolution)
         metadata[metadata_key] = entry
-        _save_metadata(dataset, metadata)
+        _save_metadata_delta(dataset, metadata_key, entry, metadata)
+        _invalidate_listing_cache()
     return {"status": status, "train_resolution": aligned_resolution, "image_resolution": image_resolution}
 
 
+@app.post("/api/datasets/{dataset}/images/{image_path:path}/extend")
+async def extend_image(dataset: str, image_path: str, payload: ExtendRequest) -> Dict[str, object]:
+    return await anyio.to_thread.run_sync(_do_extend_image, dataset, image_path, payload)
+
 
-@app.post("/api/datasets/{dataset}/images/{image_path:path}")
-async def update_image(dataset: str, image_path: str, payload: UpdateRequest) -> Dict[str, object]:
+def _do_update_image(dataset: str, image_path: str, payload: UpdateRequest) -> Dict[str, object]:
     image_file = _resolve_image_path(dataset, image_path)
     metadata_key = _make_metadata_key(dataset, image_path)
-    with _store_lock:
+    with _dataset_lock(dataset):
         metadata = _load_metadata(dataset)
         entry = metadata.get(metadata_key, {}) if isinstance(metadata.get(metadata_key), dict) else {}
         entry["caption"] = payload.caption.strip()
@@ -456,20 +871,43 @@ async def update_image(dataset: str, image_path: str, payload: UpdateRequest) ->
         if payload.apply_crop and payload.crop_data is not None:
             image_resolution = _apply_crop(image_file, payload.crop_data)
         if image_resolution is None:
-            image_resolution = _get_image_dimensions(image_file)
+            # Caption-only update: reuse the stored resolution when the file
+            # hasn't changed since it was recorded, so only a stat is needed.
+            try:
+                current_mtime = image_file.stat().st_mtime_ns
+            except OSError:
+                current_mtime = None
+            cached_resolution = entry.get("image_resolution")
+            if (
+                current_mtime is not None
+                and entry.get("image_mtime_ns") == current_mtime
+                and isinstance(cached_resolution, list)
+                and len(cached_resolution) == 2
+            ):
+                image_resolution = [int(cached_resolution[0]), int(cached_resolution[1])]
+            else:
+                image_resolution = _get_image_dimensions(image_file)
         aligned_resolution = _aligned_resolution(image_resolution[0], image_resolution[1])
         entry["train_resolution"] = aligned_resolution
+        _record_image_state(entry, image_file, image_resolution)
         metadata[metadata_key] = entry
-        _save_metadata(dataset, metadata)
+        _save_metadata_delta(dataset, metadata_key, entry, metadata)
+        _invalidate_listing_cache()
     return {"status": "ok", "train_resolution": aligned_resolution, "image_resolution": image_resolution}
 
 
+@app.post("/api/datasets/{dataset}/images/{image_path:path}")
+async def update_image(dataset: str, image_path: str, payload: UpdateRequest) -> Dict[str, object]:
+    return await anyio.to_thread.run_sync(_do_update_image, dataset, image_path, payload)
+
+
 @app.get("/api/datasets/{dataset}/export")
 async def export_metadata(dataset: str) -> FileResponse:
     train_dir = _ensure_dataset(dataset)
     metadata_path = train_dir / METADATA_FILENAME
-    if not metadata_path.exists():
-        _save_metadata(dataset, {})
+    if not metadata_path.exists() or (train_dir / JOURNAL_FILENAME).exists():
+        with _dataset_lock(dataset):
+            _save_metadata(dataset, _load_metadata(dataset))
     metadata_path = metadata_path.resolve()
     filename = f"{dataset}_metadata.json"
     return FileResponse(metadata_path, media_type="application/json", filename=filename)